@@ -1,84 +1,281 @@
 """Functions for AI-powered sleep analysis using OpenAI."""
 
-import json
+import datetime
 import os
+import threading
+from pathlib import Path
+from typing import Iterator
+
 import requests
+import jsonlib
+from http_client import SESSION, request_with_backoff
 
 
-def analyze_with_openai_from_rows(
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+DEFAULT_MODEL = "gpt-4o-mini"
+
+SYSTEM_PROMPT = (
+    "Eres un experto en sueño analítico. Analiza el sueño semanal. Los datos vienen en formato columnar: "
+    "'columns' da el orden de las columnas y cada fila de 'data' es una noche: "
+    "date (fecha), dp (sueño profundo, min), lt (sueño ligero, min), wk (tiempo despierto durante la noche, min), "
+    "start (hora de comienzo del sueño, HH:MM), stop (hora de final del sueño, HH:MM), rem (sueño REM, min), naps (siestas, min). "
+    "Devuelve un informe semanal breve en español con: "
+    "1) métricas clave y lo que significan: lo bueno y a mejorar, "
+    "2) 2 puntos fuertes y 2 a mejorar. Sé preciso, accionable, específico, usa cifras. "
+    "Da recomendaciones específicas para este usuario, no genéricas: qué días lo hizo mejor y por qué, y qué días mejorar y cómo. Menciona el día de la semana (lunes, martes, etc.)"
+)
+
+# Used instead of SYSTEM_PROMPT when build_weekly_payload() rows are sent
+WEEKLY_SYSTEM_PROMPT = (
+    "Eres un experto en sueño analítico. Analiza el sueño de un periodo largo, agregado por semanas. "
+    "Los datos vienen en formato columnar: 'columns' da el orden de las columnas y cada fila de 'data' es una semana ISO, no una noche: "
+    "week (semana ISO, AAAA-Www), nights (noches con datos), dp (sueño profundo medio por noche, min), "
+    "lt (sueño ligero medio por noche, min), wk (tiempo despierto medio por noche, min), rem (sueño REM medio por noche, min), "
+    "naps (siestas medias por noche, min), bedtime (hora media de acostarse, HH:MM), "
+    "bedtime_sd (desviación estándar de la hora de acostarse, min). "
+    "Devuelve un informe breve en español con: "
+    "1) métricas clave, su evolución entre semanas y lo que significan: lo bueno y a mejorar, "
+    "2) 2 puntos fuertes y 2 a mejorar. Sé preciso, accionable, específico, usa cifras. "
+    "Da recomendaciones específicas para este usuario, no genéricas: qué semanas lo hizo mejor y por qué, y qué semanas mejorar y cómo. "
+    "Menciona las semanas concretas."
+)
+
+# Constant part of every request body; only the user message varies per call
+BASE_BODY = {
+    "model": DEFAULT_MODEL,
+    "messages": [{"role": "system", "content": SYSTEM_PROMPT}],
+    "temperature": 0.2,
+}
+
+# (connect, read) timeouts in seconds for the chat completion request; the
+# read timeout applies between streamed chunks, not to the whole completion
+OPENAI_TIMEOUT = (10, 300)
+
+# Above this estimated prompt size, rows are sent as weekly aggregates instead
+DEFAULT_MAX_TOKENS = 100_000
+
+# Compact column names sent to OpenAI -> keys of the exported rows
+PAYLOAD_COLUMNS = [
+    ("date", "date"),
+    ("dp", "deepSleepTime"),
+    ("lt", "shallowSleepTime"),
+    ("wk", "wakeTime"),
+    ("start", "start"),
+    ("stop", "stop"),
+    ("rem", "REMTime"),
+    ("naps", "naps"),
+]
+# Sent as local clock time "HH:MM" instead of the full ISO timestamp
+CLOCK_KEYS = frozenset(("start", "stop"))
+
+
+class IncompleteStreamError(Exception):
+    """The SSE stream ended or failed before OpenAI sent `data: [DONE]`."""
+
+
+def dump_json_async(path: str, obj) -> None:
+    """
+    Write obj as indented JSON to path on a background thread (OPENAI_DEBUG
+    dumps), keeping the formatting and disk I/O off the request path.
+    Errors are ignored: the dumps are best-effort.
+    """
+    def write():
+        try:
+            Path(path).write_bytes(jsonlib.dumps(obj, indent=True))
+        except Exception:
+            pass
+
+    # Not a daemon thread: the dump is still finished if the program exits first
+    threading.Thread(target=write, name=f"dump-{path}").start()
+
+
+def clock(iso: str) -> str:
+    """'2025-09-01T23:45:12+02:00' -> '23:45' (the date is already in the row)."""
+    return iso[11:16] if iso else ""
+
+
+def build_user_payload(rows: list[dict], window_label: str) -> dict:
+    """
+    Pack rows in columnar form: column names once, then one flat list per day
+    of numbers plus date and HH:MM times.
+    Avoids repeating every key name and full timestamp per row in the prompt
+    (fewer input tokens).
+    """
+    return {
+        "ventana": window_label,
+        "columns": [name for name, _ in PAYLOAD_COLUMNS],
+        "data": [
+            [clock(r.get(key)) if key in CLOCK_KEYS else r.get(key) for _, key in PAYLOAD_COLUMNS]
+            for r in rows
+        ],
+    }
+
+
+def estimate_tokens(serialized: bytes) -> int:
+    """Cheap prompt size estimate: ~4 bytes of serialized JSON per token."""
+    return len(serialized) // 4
+
+
+def minutes_from_noon(iso: str) -> int | None:
+    """
+    Clock time of an ISO timestamp as minutes since 12:00, so bedtimes on
+    both sides of midnight (23:30, 00:30) average and spread sensibly.
+    """
+    if not iso:
+        return None
+    t = datetime.datetime.fromisoformat(iso)
+    return (t.hour * 60 + t.minute - 720) % 1440
+
+
+def build_weekly_payload(rows: list[dict], window_label: str) -> dict:
+    """
+    Aggregate rows per ISO week (nights, per-night averages in minutes, mean
+    bedtime and its standard deviation) for ranges too long to send per day.
+    """
+    import statistics  # only needed for long ranges
+
+    weeks: dict[str, list[dict]] = {}
+    for r in rows:
+        year, week, _ = datetime.date.fromisoformat(r["date"]).isocalendar()
+        weeks.setdefault(f"{year}-W{week:02d}", []).append(r)
+
+    data = []
+    for week, week_rows in weeks.items():
+        def avg(key):
+            return round(statistics.fmean(r.get(key) or 0 for r in week_rows))
+
+        bedtimes = [m for m in (minutes_from_noon(r.get("start")) for r in week_rows) if m is not None]
+        if bedtimes:
+            mean_bed = (round(statistics.fmean(bedtimes)) + 720) % 1440
+            bedtime = f"{mean_bed // 60:02d}:{mean_bed % 60:02d}"
+            bedtime_sd = round(statistics.pstdev(bedtimes))
+        else:
+            bedtime, bedtime_sd = None, None
+
+        data.append([
+            week, len(week_rows),
+            avg("deepSleepTime"), avg("shallowSleepTime"), avg("wakeTime"), avg("REMTime"), avg("naps"),
+            bedtime, bedtime_sd,
+        ])
+
+    return {
+        "ventana": window_label,
+        "columns": ["week", "nights", "dp", "lt", "wk", "rem", "naps", "bedtime", "bedtime_sd"],
+        "data": data,
+    }
+
+
+def stream_openai_from_rows(
     rows: list[dict],
     window_label: str,
-    model: str = "gpt-4o-mini",
-) -> str:
+    model: str = DEFAULT_MODEL,
+    session: requests.Session = SESSION,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+) -> Iterator[str]:
     """
-    Take exported rows and request a weekly sleep report from OpenAI.
-    Returns the report string or "" if no API key/errors.
+    Take exported rows and request a weekly sleep report from OpenAI,
+    yielding the report text piece by piece as it is generated (SSE stream).
+    If the per-day payload is estimated above max_tokens, weekly aggregates
+    are sent instead (with WEEKLY_SYSTEM_PROMPT) so the request fits the
+    model's context.
+    With OPENAI_DEBUG enabled, a single non-streamed request is made instead
+    so the full request/response can be dumped to disk.
+    Yields nothing if no API key/errors. Raises IncompleteStreamError if the
+    stream breaks after text was yielded, so a truncated report is never
+    taken for a finished one.
     """
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         print("[openai] Falta OPENAI_API_KEY en el entorno. Salto análisis.")
-        return ""
+        return
 
     debug = str(os.getenv("OPENAI_DEBUG", "0")).lower() in ("1", "true", "yes")
 
-    system_prompt = (
-        "Eres un experto en sueño analítico. Analiza el sueño semanal en la lista de diccionarios con las claves: "
-        "date, deepSleepTime, shallowSleepTime, wakeTime (tiempo despierto durante la noche), start (comienzo del sueño), stop (final del sueño), REMTime, naps(siestas). "
-        "Devuelve un informe semanal breve en español con: "
-        "1) métricas clave y lo que significan: lo bueno y a mejorar, "
-        "2) 2 puntos fuertes y 2 a mejorar. Sé preciso, accionable, específico, usa cifras. "
-        "Da recomendaciones específicas para este usuario, no genéricas: qué días lo hizo mejor y por qué, y qué días mejorar y cómo. Menciona el día de la semana (lunes, martes, etc.)"
-    )
+    # Serialized once: the same bytes give the size estimate and the message
+    user_content = jsonlib.dumps(build_user_payload(rows, window_label))
+    system_message = BASE_BODY["messages"][0]
+    approx_tokens = estimate_tokens(user_content)
+    if approx_tokens > max_tokens:
+        print(f"[openai] ~{approx_tokens} tokens for {len(rows)} rows (> {max_tokens}); sending weekly aggregates.")
+        user_content = jsonlib.dumps(build_weekly_payload(rows, window_label))
+        system_message = {"role": "system", "content": WEEKLY_SYSTEM_PROMPT}
 
-    user_payload = {
-        "ventana": window_label,
-        "rows": rows,
-    }
-
-    url = "https://api.openai.com/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
     }
     body = {
+        **BASE_BODY,
         "model": model,
         "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": json.dumps(user_payload, ensure_ascii=False)}
+            system_message,
+            {"role": "user", "content": user_content.decode()}
         ],
-        "temperature": 0.2,
     }
 
     if debug:
-        try:
-            with open("openai_request.json", "w", encoding="utf-8") as f:
-                json.dump({"url": url, "headers": {"Content-Type": "application/json", "Authorization": "Bearer ***redacted***"},
-                           "body": body}, f, ensure_ascii=False, indent=2)
-        except Exception:
-            pass
+        dump_json_async("openai_request.json", {
+            "url": OPENAI_URL,
+            "headers": {"Content-Type": "application/json", "Authorization": "Bearer ***redacted***"},
+            "body": body,
+        })
+    else:
+        body["stream"] = True
+    # The body is serialized exactly once and sent as raw bytes
+    body_bytes = jsonlib.dumps(body)
 
+    yielded = done = False
     try:
-        resp = requests.post(url, headers=headers, json=body, timeout=60)
-        request_id = resp.headers.get("x-request-id")
-        resp.raise_for_status()
+        if debug:
+            resp = request_with_backoff(session, "POST", OPENAI_URL, headers=headers, data=body_bytes,
+                                        timeout=OPENAI_TIMEOUT)
+            request_id = resp.headers.get("x-request-id")
+            resp.raise_for_status()
 
-        data = resp.json()
+            data = jsonlib.loads(resp.content)
 
-        if debug:
-            try:
-                with open("openai_response.json", "w", encoding="utf-8") as f:
-                    json.dump({"request_id": request_id, "response": data}, f, ensure_ascii=False, indent=2)
-            except Exception:
-                pass
+            dump_json_async("openai_response.json", {"request_id": request_id, "response": data})
 
-        content = (
-            data.get("choices", [{}])[0]
-                .get("message", {})
-                .get("content", "")
-        )
+            content = (
+                data.get("choices", [{}])[0]
+                    .get("message", {})
+                    .get("content", "")
+            )
+            if content:
+                yield content
+            return
 
-        return (content or "").strip()
+        resp = request_with_backoff(session, "POST", OPENAI_URL, headers=headers, data=body_bytes,
+                                    stream=True, timeout=OPENAI_TIMEOUT)
+        resp.raise_for_status()
 
+        with resp:
+            # SSE responses carry no charset, requests would fall back to latin-1
+            resp.encoding = "utf-8"
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                chunk = line[len("data: "):]
+                if chunk == "[DONE]":
+                    done = True
+                    break
+
+                delta = (
+                    (jsonlib.loads(chunk).get("choices") or [{}])[0]
+                        .get("delta", {})
+                        .get("content")
+                )
+                if delta:
+                    yielded = True
+                    yield delta
+
+        if not done:
+            raise IncompleteStreamError("stream ended without [DONE]")
+
+    except IncompleteStreamError:
+        if yielded:
+            raise
+        print("[openai] Error: stream ended without any content")
     except requests.HTTPError as e:
         snippet = ""
         try:
@@ -87,7 +284,27 @@ def analyze_with_openai_from_rows(
             pass
         print(f"[openai] HTTP {getattr(e.response,'status_code', '???')}: {snippet}")
     except Exception as e:
+        if yielded:
+            raise IncompleteStreamError(str(e)) from e
         print(f"[openai] Error: {e}")
 
-    return ""
 
+def analyze_with_openai_from_rows(
+    rows: list[dict],
+    window_label: str,
+    model: str = DEFAULT_MODEL,
+    session: requests.Session = SESSION,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+) -> str:
+    """
+    Take exported rows and request a weekly sleep report from OpenAI.
+    Returns the report string or "" if no API key/errors (including a
+    stream that broke partway).
+    """
+    try:
+        return "".join(stream_openai_from_rows(
+            rows, window_label, model=model, session=session, max_tokens=max_tokens,
+        )).strip()
+    except IncompleteStreamError as e:
+        print(f"[openai] Informe incompleto, se descarta: {e}")
+        return ""
@@ -1,11 +1,20 @@
 """Authentication functions for Mi Fit/Zepp API."""
 
+import hashlib
+import json
+import os
+import time
 import requests
 import urllib.parse
+from http_client import SESSION, request_with_backoff
 from utils import fail
 
 
-def mifit_auth_email(email: str, password: str) -> dict:
+AUTH_CACHE_PATH = os.path.expanduser("~/.cache/zepp-sleep/auth.json")
+AUTH_CACHE_MAX_AGE = 7 * 24 * 3600  # seconds, when the login gives no app_ttl
+
+
+def mifit_auth_email(email: str, password: str, session: requests.Session = SESSION) -> dict:
     """
     Initial login with email/password to obtain 'access' and 'country_code'
     from Location header (without following redirect).
@@ -26,19 +35,19 @@ def mifit_auth_email(email: str, password: str) -> dict:
         'User-Agent': 'Mi Fit/4.0.9 (iPhone; iOS 14.0; Scale/2.0)',
         'Accept': 'application/json',
         'Accept-Language': 'es-ES,es;q=0.9',
-        'Accept-Encoding': 'gzip, deflate',
     }
     
-    r = requests.post(auth_url, data=data, headers=headers, allow_redirects=False)
-    
-    # Handle rate limits
+    r = request_with_backoff(session, "POST", auth_url, data=data, headers=headers,
+                             allow_redirects=False)
+
+    # Rate limits are retried with backoff; only give up once retries are exhausted
     if r.status_code == 429:
         retry_after = r.headers.get('Retry-After', 'desconocido')
         print(f"❌ Rate limit alcanzado (429). Retry-After: {retry_after}")
         print("💡 Sugerencia: La API de Huami puede tener límites diarios/semanales.")
         print("   Intenta de nuevo en unas horas o mañana.")
         raise SystemExit("Script detenido por rate limit")
-    
+
     r.raise_for_status()
 
     loc = urllib.parse.urlparse(r.headers.get("location", ""))
@@ -55,10 +64,10 @@ def mifit_auth_email(email: str, password: str) -> dict:
         "grant_type": "access_token",
         "country_code": q["country_code"],
         "code": q["access"],
-    })
+    }, session=session)
 
 
-def mifit_login_with_token(login_data: dict) -> dict:
+def mifit_login_with_token(login_data: dict, session: requests.Session = SESSION) -> dict:
     """
     Exchange 'access' token for full credentials at:
     https://account.huami.com/v2/client/login
@@ -76,7 +85,7 @@ def mifit_login_with_token(login_data: dict) -> dict:
     }
     data.update(login_data)
 
-    r = requests.post(login_url, data=data, allow_redirects=False)
+    r = request_with_backoff(session, "POST", login_url, data=data, allow_redirects=False)
     result = r.json()
 
     if "token_info" not in result or "app_token" not in result["token_info"]:
@@ -85,3 +94,59 @@ def mifit_login_with_token(login_data: dict) -> dict:
     print("[login] App token and user id obtained.")
     return result
 
+
+def email_key(email: str) -> str:
+    """Hash of the account email, so the cache is tied to it without storing it."""
+    return hashlib.sha256(email.strip().lower().encode("utf-8")).hexdigest()
+
+
+def load_cached_auth(email: str, path: str = AUTH_CACHE_PATH) -> dict | None:
+    """
+    Return the auth info ({"token_info": ...}) saved by save_cached_auth(),
+    or None if there is no cache, it is unreadable, belongs to another
+    account or has expired.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("email") != email_key(email):
+        return None
+    app_token, user_id = cached.get("app_token"), cached.get("user_id")
+    if not app_token or not user_id:
+        return None
+    if time.time() > cached.get("expires_at", 0):
+        print("[login] Cached app token expired; logging in again.")
+        return None
+
+    print("[login] Using cached app token.")
+    return {"token_info": {"app_token": app_token, "user_id": user_id}}
+
+
+def save_cached_auth(auth_info: dict, email: str, path: str = AUTH_CACHE_PATH) -> None:
+    """
+    Persist app_token and user_id for email (readable only by the current
+    user) for later runs. Expires after the login's app_ttl when given,
+    otherwise after AUTH_CACHE_MAX_AGE seconds.
+    """
+    token_info = auth_info["token_info"]
+    try:
+        ttl = int(token_info.get("app_ttl") or AUTH_CACHE_MAX_AGE)
+    except (TypeError, ValueError):
+        ttl = AUTH_CACHE_MAX_AGE
+    cached = {
+        "email": email_key(email),
+        "expires_at": int(time.time()) + ttl,
+        "app_token": token_info["app_token"],
+        "user_id": token_info["user_id"],
+    }
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cached, f)
+        os.chmod(path, 0o600)
+    except OSError as e:
+        print(f"[login] Could not cache app token: {e}")
@@ -22,3 +22,10 @@ def get_openai_api_key():
     """Get OpenAI API key from environment."""
     return os.getenv("OPENAI_API_KEY")
 
+
+def get_openai_deadline() -> float:
+    """Seconds to wait for the OpenAI report before emailing without it (OPENAI_DEADLINE, default 60)."""
+    try:
+        return float(os.getenv("OPENAI_DEADLINE", "60"))
+    except ValueError:
+        return 60.0
@@ -1,25 +1,82 @@
 """Functions for fetching and processing sleep data from Mi Fit/Zepp API."""
 
-import base64
+import binascii
 import csv
-import json
+import io
+import operator
+import os
 import requests
-from tabulate import tabulate
-from utils import to_madrid_iso
+from concurrent.futures import ThreadPoolExecutor
+import jsonlib
+from http_client import SESSION, request_with_backoff
+from utils import split_range, to_madrid_iso
 
 
-def get_band_data(auth_info: dict, from_date: str, to_date: str, output_file: str = "sleep_export.csv"):
+# Stage modes counted as REM (7 = brief episodes, 8 = longer episodes)
+REM_MODES = frozenset((7, 8))
+
+# Scalar fields of a "slp" object
+SLP_KEYS = ("dp", "lt", "wk", "st", "ed")
+slp_values = operator.itemgetter(*SLP_KEYS)
+
+# Exported columns, in CSV and console table order
+FIELDS = [
+    "date","deepSleepTime","shallowSleepTime","wakeTime","start","stop","REMTime","naps"
+]
+
+# Values of a row dict in FIELDS order
+row_values = operator.itemgetter(*FIELDS)
+
+
+def get_band_data(
+    auth_info: dict,
+    from_date: str,
+    to_date: str,
+    session: requests.Session = SESSION,
+    chunk_days: int = 14,
+    max_workers: int = 4,
+):
     """
     Download data range [from_date, to_date] and build rows for CSV/table.
+    Writing the CSV is left to write_csv(), so callers can run it off the
+    critical path.
+
+    Ranges longer than chunk_days are split into sub-ranges fetched (and
+    decoded) concurrently, then merged back in date order.
+    """
+    print(f"[fetch] Retrieving mi band data from {from_date} to {to_date}")
+
+    ranges = split_range(from_date, to_date, chunk_days)
+    if len(ranges) == 1:
+        rows = fetch_band_rows(auth_info, from_date, to_date, session=session)
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(ranges))) as ex:
+            chunks = ex.map(lambda r: fetch_band_rows(auth_info, r[0], r[1], session=session), ranges)
+            rows = sorted((row for chunk in chunks for row in chunk), key=operator.itemgetter("date"))
+
+    print(f"\n[fetch] Got {len(rows)} rows\n")
+    print_rows(rows)
+
+    return rows
+
+
+def fetch_band_rows(
+    auth_info: dict,
+    from_date: str,
+    to_date: str,
+    session: requests.Session = SESSION,
+) -> list[dict]:
+    """
+    Single band_data.json request for [from_date, to_date], decoded into rows.
 
     Important about units:
     - dp/lt/wk already come in minutes.
     - stage[].start / stage[].stop also come in minutes (relative to the same day),
       so (stop - start) gives minutes for each segment.
     """
-    print(f"[fetch] Retrieving mi band data from {from_date} to {to_date}")
-
     url = "https://api-mifit.huami.com/v1/data/band_data.json"
+    # requests already sends Accept-Encoding: gzip, deflate and decompresses
+    # resp.content transparently; the base64 summaries compress well
     headers = {"apptoken": auth_info["token_info"]["app_token"]}
     params = {
         "query_type": "summary",
@@ -29,41 +86,41 @@ def get_band_data(auth_info: dict, from_date: str, to_date: str, output_file: st
         "to_date": to_date,
     }
 
-    resp = requests.get(url, params=params, headers=headers)
+    resp = request_with_backoff(session, "GET", url, params=params, headers=headers)
     resp.raise_for_status()
 
+    # Drop the raw body as soon as it is parsed, so it is not held in memory
+    # alongside the decoded summaries and rows
+    days = jsonlib.loads(resp.content).get("data", [])
+    del resp
+
     rows = []
 
-    for daydata in resp.json().get("data", []):
+    for daydata in days:
+        summary_raw = daydata.get("summary")
+        if not summary_raw:
+            continue
         day = daydata["date_time"]
 
-        summary_b = base64.b64decode(daydata.get("summary", ""))
-        summary = json.loads(summary_b) if summary_b else {}
+        summary_b = binascii.a2b_base64(summary_raw)
+        summary = jsonlib.loads(summary_b) if summary_b else {}
 
         if "slp" not in summary:
             continue
 
         slp = summary["slp"]
 
-        deep  = slp.get("dp", 0)
-        light = slp.get("lt", 0)
-        wake  = slp.get("wk", 0)
-
-        start_iso = to_madrid_iso(slp.get("st", 0))
-        stop_iso  = to_madrid_iso(slp.get("ed", 0))
-
-        # Calculate REM from segments
-        # Sum separately mode 7 and mode 8 minutes, then expose the sum (REMTime)
-        rem7 = 0
-        rem8 = 0
-        for s in slp.get("stage", []):
-            mode = s.get("mode")
-            dur = (s.get("stop", 0) - s.get("start", 0))
-            if mode == 7:
-                rem7 += dur
-            elif mode == 8:
-                rem8 += dur
-            # other modes (4,5, etc.) not counted here because REM = 7 + 8
+        try:
+            deep, light, wake, st, ed = slp_values(slp)
+        except KeyError:
+            # some field missing: default each absent one to 0, as before
+            deep, light, wake, st, ed = (slp.get(k, 0) for k in SLP_KEYS)
+
+        start_iso = to_madrid_iso(st)
+        stop_iso  = to_madrid_iso(ed)
+
+        # REMTime = minutes in mode 7 + mode 8 segments
+        rem = rem_minutes(slp.get("stage", ()))
 
         rows.append({
             "date": day,
@@ -72,20 +129,79 @@ def get_band_data(auth_info: dict, from_date: str, to_date: str, output_file: st
             "wakeTime": wake,
             "start": start_iso,
             "stop": stop_iso,
-            "REMTime": rem7 + rem8,
+            "REMTime": rem,
             "naps": slp.get("nap", 0),
         })
 
-    fields = [
-        "date","deepSleepTime","shallowSleepTime","wakeTime","start","stop","REMTime","naps"
-    ]
-    with open(output_file, "w", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=fields)
-        w.writeheader()
-        w.writerows(rows)
+    return rows
 
-    print(f"\n[done] Exported {len(rows)} rows to {output_file}\n")
-    print(tabulate(rows, headers="keys", tablefmt="github"))
 
-    return rows
+def rem_minutes(stages) -> int:
+    """
+    Sum the minutes of the REM segments (mode in REM_MODES; other modes such
+    as 4/5 are not REM). Missing keys count as 0.
+    """
+    try:
+        return sum(s["stop"] - s["start"] for s in stages if s["mode"] in REM_MODES)
+    except KeyError:
+        return sum(
+            s.get("stop", 0) - s.get("start", 0)
+            for s in stages
+            if s.get("mode") in REM_MODES
+        )
+
+
+def print_rows(rows: list[dict]) -> None:
+    """
+    Print rows as a console table, unless there are more than ZEPP_TABLE_MAX
+    (default 14) of them: rendering long ranges is slow and unreadable anyway.
+    """
+    try:
+        table_max = int(os.getenv("ZEPP_TABLE_MAX", "14"))
+    except ValueError:
+        table_max = 14
+
+    if not rows:
+        return
+    if len(rows) > table_max:
+        print(f"[fetch] Table suppressed for {len(rows)} rows (ZEPP_TABLE_MAX={table_max}); see the CSV export.")
+        return
+    print(format_table(rows, FIELDS))
 
+
+def format_table(rows: list[dict], fields: list[str]) -> str:
+    """
+    Render rows as a GitHub-style markdown table: one width pass over the
+    cells, numeric columns right-aligned, text columns left-aligned.
+    """
+    cells = [[str(r.get(f, "")) for f in fields] for r in rows]
+    widths = [max([len(f)] + [len(c[i]) for c in cells]) for i, f in enumerate(fields)]
+    numeric = [all(isinstance(r.get(f), (int, float)) for r in rows) for f in fields]
+
+    def line(values):
+        return "| " + " | ".join(
+            v.rjust(w) if num else v.ljust(w) for v, w, num in zip(values, widths, numeric)
+        ) + " |"
+
+    out = [line(fields), "|" + "|".join("-" * (w + 2) for w in widths) + "|"]
+    out.extend(line(c) for c in cells)
+    return "\n".join(out)
+
+
+def write_csv(rows, output_file: str = "sleep_export.csv") -> bytes:
+    """
+    Write rows (any iterable of row dicts) to output_file as CSV (FIELDS order).
+    The CSV is built in memory and also returned (UTF-8 bytes), so it can be
+    attached to the email without reading the file back.
+    """
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+    w = csv.writer(text)
+    w.writerow(FIELDS)
+    w.writerows(map(row_values, rows))
+    data = buf.getvalue()
+    text.detach()
+
+    with open(output_file, "wb") as f:
+        f.write(data)
+    return data
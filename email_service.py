@@ -1,21 +1,126 @@
 """Email sending functionality using SMTP."""
 
-import mimetypes
 import os
-import smtplib
-from email.message import EmailMessage
+from email.message import EmailMessage  # already loaded by requests (http.client)
+from typing import TYPE_CHECKING
 
+# smtplib is imported where a connection is opened, so runs that never
+# send an email don't pay for it
+if TYPE_CHECKING:
+    import smtplib
 
-def send_email(subject: str, body: str, to_addrs, attachments: list[str] | None = None) -> bool:
+
+# MIME types of the files this script attaches, so the mimetypes database
+# (read from disk on first use) is only loaded for anything else
+MIME_TYPES = {
+    ".csv": "text/csv",
+    ".md": "text/markdown",
+}
+
+
+def guess_mime_type(path: str) -> str:
+    """MIME type for an attachment path (application/octet-stream if unknown)."""
+    ctype = MIME_TYPES.get(os.path.splitext(path)[1].lower())
+    if ctype:
+        return ctype
+
+    import mimetypes
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+class SmtpSender:
     """
-    Send email with subject, body text and optionally attachments.
-    Uses SMTP_* and MAIL_* environment variables for configuration.
+    SMTP connection that stays open across several sends, so the TLS
+    handshake and LOGIN are paid once. Uses SMTP_* environment variables
+    (SSL on port 465, STARTTLS otherwise).
 
-    subject:    Email subject
-    body:       Message text (sent as plain text)
-    to_addrs:   Recipient(s). Can be a string ("a@x.com") or list.
-    attachments: List of file paths to attach (CSV, MD, etc.)
-    Returns True if sent successfully, False if error.
+        with SmtpSender() as sender:
+            for msg in messages:
+                sender.send(msg)
+    """
+
+    def __init__(self):
+        self.smtp: smtplib.SMTP | None = None
+
+    def open(self) -> bool:
+        """Connect and log in (no-op if already open). Returns True on success."""
+        if self.smtp is not None:
+            return True
+
+        import smtplib
+
+        host = os.getenv("SMTP_HOST")
+        port = int(os.getenv("SMTP_PORT", "465"))
+        user = os.getenv("SMTP_USER")
+        password = os.getenv("SMTP_PASS")
+
+        if not all([host, port, user, password]):
+            return False
+
+        s = None
+        try:
+            if port == 465:
+                s = smtplib.SMTP_SSL(host, port, timeout=60)
+            else:
+                s = smtplib.SMTP(host, port, timeout=60)
+                s.starttls()
+            s.login(user, password)
+        except Exception as e:
+            print(f"❌ Error conectando a SMTP: {e}")
+            if s is not None:
+                s.close()
+            return False
+
+        self.smtp = s
+        return True
+
+    def close(self) -> None:
+        """Close the connection, ignoring errors."""
+        s, self.smtp = self.smtp, None
+        if s is None:
+            return
+        try:
+            s.quit()
+        except Exception:
+            s.close()
+
+    def send(self, msg: EmailMessage) -> bool:
+        """
+        Send msg over the open connection (opening it if needed).
+        If the server dropped an idle connection, reconnects once.
+        Returns True if sent successfully, False if error.
+        """
+        import smtplib
+
+        for attempt in range(2):
+            if not self.open():
+                print("❌ Error enviando email: no se pudo conectar a SMTP")
+                return False
+            try:
+                self.smtp.send_message(msg)
+                print("✉️  Email enviado correctamente.")
+                return True
+            except smtplib.SMTPServerDisconnected as e:
+                self.close()
+                if attempt:
+                    print(f"❌ Error enviando email: {e}")
+            except Exception as e:
+                print(f"❌ Error enviando email: {e}")
+                return False
+        return False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build_message(subject: str, body: str, to_addrs, attachments: list | None = None) -> EmailMessage | None:
+    """
+    Build the EmailMessage for send_email() (see there for the arguments).
+    Returns None if SMTP/MAIL configuration or recipients are missing.
     """
     host = os.getenv("SMTP_HOST")
     port = int(os.getenv("SMTP_PORT", "465"))
@@ -30,7 +135,7 @@ def send_email(subject: str, body: str, to_addrs, attachments: list[str] | None
 
     if not all([host, port, user, password, from_addr]) or not to_addrs_list:
         print("❌ Faltan SMTP_HOST/PORT/USER/PASS/MAIL_FROM o MAIL_TO en .env")
-        return False
+        return None
 
     msg = EmailMessage()
     msg["From"] = from_addr
@@ -38,12 +143,17 @@ def send_email(subject: str, body: str, to_addrs, attachments: list[str] | None
     msg["Subject"] = subject
     msg.set_content(body)
 
-    for path in (attachments or []):
-        try:
-            ctype, _ = mimetypes.guess_type(path)
-            if not ctype:
-                ctype = "application/octet-stream"
+    for item in (attachments or []):
+        if isinstance(item, tuple):
+            # In-memory attachment: (filename, data, mimetype)
+            filename, data, ctype = item
             maintype, subtype = ctype.split("/", 1)
+            msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
+            continue
+
+        path = item
+        try:
+            maintype, subtype = guess_mime_type(path).split("/", 1)
 
             with open(path, "rb") as f:
                 msg.add_attachment(
@@ -55,21 +165,34 @@ def send_email(subject: str, body: str, to_addrs, attachments: list[str] | None
         except Exception as e:
             print(f"⚠️ No pude adjuntar {path}: {e}")
 
-    try:
-        if port == 465:
-            with smtplib.SMTP_SSL(host, port, timeout=60) as s:
-                s.login(user, password)
-                s.send_message(msg)
-        else:
-            with smtplib.SMTP(host, port, timeout=60) as s:
-                s.starttls()
-                s.login(user, password)
-                s.send_message(msg)
+    return msg
 
-        print("✉️  Email enviado correctamente.")
-        return True
 
-    except Exception as e:
-        print(f"❌ Error enviando email: {e}")
+def send_email(
+    subject: str,
+    body: str,
+    to_addrs,
+    attachments: list | None = None,
+    sender: SmtpSender | None = None,
+) -> bool:
+    """
+    Send email with subject, body text and optionally attachments.
+    Uses SMTP_* and MAIL_* environment variables for configuration.
+
+    subject:    Email subject
+    body:       Message text (sent as plain text)
+    to_addrs:   Recipient(s). Can be a string ("a@x.com") or list.
+    attachments: List of file paths to attach (CSV, MD, etc.) and/or
+                (filename, data, mimetype) tuples for in-memory content.
+    sender:     SmtpSender to reuse (left open). A one-shot connection is
+                used if not given.
+    Returns True if sent successfully, False if error.
+    """
+    msg = build_message(subject, body, to_addrs, attachments)
+    if msg is None:
         return False
 
+    if sender is not None:
+        return sender.send(msg)
+    with SmtpSender() as one_shot:
+        return one_shot.send(msg)
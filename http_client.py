@@ -0,0 +1,88 @@
+"""Shared HTTP session for the Mi Fit/Zepp and OpenAI calls."""
+
+import datetime
+import email.utils
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def build_session() -> requests.Session:
+    """
+    Build a requests.Session with a pooled HTTPS adapter, so calls to the same
+    host reuse keep-alive TCP/TLS connections instead of opening a new one per
+    request. The login, token exchange and band data calls each go to a
+    different Huami host; the reuse is mainly between the concurrent 14-day
+    band data requests.
+    The adapter only retries connection errors; HTTP status retries are
+    handled by request_with_backoff().
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5),
+    ))
+    return session
+
+
+SESSION = build_session()
+
+
+def retry_after_seconds(value: str | None) -> float | None:
+    """Parse a Retry-After header (delay in seconds or HTTP-date) into seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def request_with_backoff(
+    session: requests.Session,
+    method: str,
+    url: str,
+    *,
+    max_retries: int = 4,
+    max_wait: float = 60.0,
+    **kw,
+) -> requests.Response:
+    """
+    Send a request, retrying on 429/5xx with exponential backoff (2, 4, 8, 16 s
+    plus jitter). On 429/503 the server's Retry-After is honored when longer.
+    Gives up early if Retry-After asks for more than max_wait seconds.
+    Returns the last response; callers decide what to do with a final error.
+    """
+    for attempt in range(max_retries + 1):
+        resp = session.request(method, url, **kw)
+        if resp.status_code != 429 and resp.status_code < 500:
+            return resp
+        if attempt == max_retries:
+            break
+
+        delay = 2 ** (attempt + 1)
+        if resp.status_code in (429, 503):
+            retry_after = retry_after_seconds(resp.headers.get("Retry-After"))
+            if retry_after is not None:
+                if retry_after > max_wait:
+                    break
+                delay = max(retry_after, delay)
+        delay += random.uniform(0, 1)
+
+        print(f"[http] {method} {url} -> HTTP {resp.status_code}, retrying in {delay:.1f}s "
+              f"({attempt + 1}/{max_retries})")
+        resp.close()
+        time.sleep(delay)
+
+    return resp
@@ -10,41 +10,148 @@ See README.md for detailed API flow and technical implementation details.
 """
 
 import os
-from ai_analysis import analyze_with_openai_from_rows
-from auth import mifit_auth_email
-from config import get_credentials, get_openai_api_key
-from data_fetch import get_band_data
-from email_service import send_email
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from ai_analysis import IncompleteStreamError, stream_openai_from_rows
+from auth import load_cached_auth, mifit_auth_email, save_cached_auth
+from config import get_credentials, get_openai_api_key, get_openai_deadline
+from data_fetch import get_band_data, write_csv
+from email_service import SmtpSender, send_email
 from utils import last_complete_week_range, last_n_days_range
 
 
+CSV_FILE = "sleep_export.csv"
+REPORT_FILE = "sleep_report_ai.md"
+
+
+def report_heading(window_label: str) -> str:
+    """Markdown title of the AI report file."""
+    return f"# Informe de sueño Mi Fit / Zepp ({window_label})\n\n"
+
+
+def write_streamed_report(chunks, window_label: str, path: str, stop: threading.Event | None = None) -> str:
+    """
+    Write the AI report to `path` and stdout as its chunks arrive.
+    The file is only created once the first chunk is received.
+    If `stop` gets set, gives up at the next chunk, closes the stream and
+    removes the partial file; the same happens if the stream breaks partway.
+    Returns the full report text ("" if nothing was received, stopped or broken).
+    """
+    parts = []
+    f = None
+    try:
+        for delta in chunks:
+            if stop is not None and stop.is_set():
+                chunks.close()
+                break
+            if f is None:
+                f = open(path, "w", encoding="utf-8")
+                f.write(report_heading(window_label))
+                print("\n[AI] Análisis semanal (OpenAI):\n")
+            f.write(delta)
+            f.flush()
+            print(delta, end="", flush=True)
+            parts.append(delta)
+
+        if stop is not None and stop.is_set():
+            parts = []
+        elif f is not None:
+            f.write("\n")
+            print(f"\n\n[AI] Informe guardado en {path}")
+    except IncompleteStreamError as e:
+        parts = []
+        print(f"\n\n[AI] Informe incompleto, se descarta: {e}")
+    finally:
+        if f is not None:
+            f.close()
+
+    # Don't leave a truncated report behind (main() may already have removed it)
+    if not parts and f is not None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    return "".join(parts).strip()
+
+
+def fetch_rows(email: str, password: str, from_date: str, to_date: str) -> list[dict]:
+    """
+    Fetch band data with the cached app token when available, skipping the two
+    login round-trips. Logs in again (and re-caches) if the token is rejected.
+    """
+    auth = load_cached_auth(email)
+    if auth:
+        try:
+            return get_band_data(auth, from_date=from_date, to_date=to_date)
+        except requests.HTTPError as e:
+            if getattr(e.response, "status_code", None) not in (401, 403):
+                raise
+            print("[login] Cached app token rejected; logging in again.")
+
+    auth = mifit_auth_email(email, password)
+    save_cached_auth(auth, email)
+    return get_band_data(auth, from_date=from_date, to_date=to_date)
+
+
 def main():
     FROM, TO = last_complete_week_range("Europe/Madrid")
     # FROM, TO = last_n_days_range(7, "Europe/Madrid")
     print(f"[range] Using last week -> FROM={FROM}, TO={TO} (Madrid timezone)")
 
     email, password = get_credentials()
-    auth = mifit_auth_email(email, password)
-    rows = get_band_data(auth, from_date=FROM, to_date=TO, output_file="sleep_export.csv")
+    rows = fetch_rows(email, password, FROM, TO)
 
     window_label = f"Semana {FROM} a {TO}"
-    analysis = analyze_with_openai_from_rows(rows, window_label)
 
-    if analysis:
-        with open("sleep_report_ai.md", "w", encoding="utf-8") as f:
-            f.write(f"# Informe de sueño Mi Fit / Zepp ({window_label})\n\n")
-            f.write(analysis + "\n")
-        print("\n[AI] Análisis semanal (OpenAI):\n")
-        print(analysis)
-        print("\n[AI] Informe guardado en sleep_report_ai.md")
+    # The CSV write and the SMTP connect+login don't depend on the OpenAI
+    # request: run all three concurrently. The report gets a deadline so a
+    # slow OpenAI response can't hold back the email. It runs on a daemon
+    # thread so a stalled stream can't keep the process alive afterwards.
+    sender = SmtpSender()
+    stop = threading.Event()
+    deadline = get_openai_deadline()
+    ai_result = {}
+    ai_thread = threading.Thread(
+        target=lambda: ai_result.update(analysis=write_streamed_report(
+            stream_openai_from_rows(rows, window_label), window_label, REPORT_FILE, stop,
+        )),
+        name="openai-report",
+        daemon=True,
+    )
+    ai_thread.start()
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        csv_fut = ex.submit(write_csv, rows, CSV_FILE)
+        smtp_fut = ex.submit(sender.open)
+        ai_thread.join(timeout=deadline)
+        if ai_thread.is_alive():
+            stop.set()
+            analysis = ""
+            print(f"\n[AI] Sin informe completo de OpenAI tras {deadline:.0f}s; se envía el email sin análisis.")
+        else:
+            analysis = ai_result.get("analysis", "")
+        csv_bytes = csv_fut.result()
+        smtp_fut.result()
+    print(f"\n[done] Exported {len(rows)} rows to {CSV_FILE}\n")
 
     subject = f"Informe de sueño Zepp — {window_label}"
     body = (analysis or f"(Sin análisis de IA)\nSe exportaron {len(rows)} filas del {FROM} al {TO}.")
-    attachments = ["sleep_export.csv"]
-    if os.path.exists("sleep_report_ai.md"):
-        attachments.append("sleep_report_ai.md")
+    # Attach what is already in memory instead of reading the files back
+    attachments = [(CSV_FILE, csv_bytes, "text/csv")]
+    if analysis:
+        report = report_heading(window_label) + analysis + "\n"
+        attachments.append((REPORT_FILE, report.encode("utf-8"), "text/markdown"))
+
+    with sender:
+        send_email(subject, body, os.getenv("MAIL_TO", ""), attachments=attachments, sender=sender)
 
-    send_email(subject, body, os.getenv("MAIL_TO", ""), attachments=attachments)
+    if stop.is_set():
+        # The timed-out report dies with the process: remove its partial file
+        try:
+            os.remove(REPORT_FILE)
+        except FileNotFoundError:
+            pass
 
 
 if __name__ == "__main__":
@@ -4,6 +4,19 @@ import datetime
 from zoneinfo import ZoneInfo
 
 
+# Resolved once at import; to_madrid_iso() runs for every exported row
+MADRID_TZ = ZoneInfo("Europe/Madrid")
+TZ_CACHE: dict[str, ZoneInfo] = {"Europe/Madrid": MADRID_TZ}
+
+
+def get_tz(tz_name: str) -> ZoneInfo:
+    """Return the ZoneInfo for tz_name, building it only the first time."""
+    tz = TZ_CACHE.get(tz_name)
+    if tz is None:
+        tz = TZ_CACHE[tz_name] = ZoneInfo(tz_name)
+    return tz
+
+
 def fail(msg: str):
     """Print error and exit program."""
     print(f"Error: {msg}")
@@ -14,13 +27,17 @@ def to_madrid_iso(ts: int) -> str:
     """Convert epoch (seconds) to ISO in Europe/Madrid timezone."""
     if not ts:
         return ""
-    utc_dt = datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc)
-    return utc_dt.astimezone(ZoneInfo("Europe/Madrid")).replace(microsecond=0).isoformat()
+    return datetime.datetime.fromtimestamp(ts, MADRID_TZ).isoformat(timespec="seconds")
+
+
+def today_in(tz_name: str = "Europe/Madrid") -> datetime.date:
+    """Current date in the tz_name timezone (shared by the range helpers)."""
+    return datetime.datetime.now(get_tz(tz_name)).date()
 
 
 def last_n_days_range(days: int = 7, tz_name: str = "Europe/Madrid") -> tuple[str, str]:
     """Return FROM-TO in YYYY-MM-DD format for last N days INCLUDING today."""
-    today = datetime.datetime.now(tz=ZoneInfo(tz_name)).date()
+    today = today_in(tz_name)
     from_date = today - datetime.timedelta(days=days-1)
     return from_date.isoformat(), today.isoformat()
 
@@ -30,8 +47,28 @@ def last_complete_week_range(tz_name: str = "Europe/Madrid") -> tuple[str, str]:
     Return Monday-Sunday of the PREVIOUS complete week (YYYY-MM-DD dates).
     Example: if today is Wednesday 2025-09-10, returns 2025-09-01 to 2025-09-07.
     """
-    today = datetime.datetime.now(tz=ZoneInfo(tz_name)).date()
+    today = today_in(tz_name)
     week_start = today - datetime.timedelta(days=today.weekday() + 7)
     week_end = week_start + datetime.timedelta(days=6)
     return week_start.isoformat(), week_end.isoformat()
 
+
+def split_range(from_date: str, to_date: str, chunk_days: int = 14) -> list[tuple[str, str]]:
+    """
+    Split the inclusive range [from_date, to_date] (YYYY-MM-DD) into consecutive
+    sub-ranges of at most chunk_days days each.
+    Example: 2025-09-01..2025-09-20 with 14 -> [(09-01, 09-14), (09-15, 09-20)].
+    """
+    if chunk_days < 1:
+        raise ValueError(f"chunk_days must be at least 1, got {chunk_days}")
+
+    start = datetime.date.fromisoformat(from_date)
+    end = datetime.date.fromisoformat(to_date)
+    step = datetime.timedelta(days=chunk_days)
+
+    ranges = []
+    while start <= end:
+        chunk_end = min(start + step - datetime.timedelta(days=1), end)
+        ranges.append((start.isoformat(), chunk_end.isoformat()))
+        start = chunk_end + datetime.timedelta(days=1)
+    return ranges or [(from_date, to_date)]